@@ -9,7 +9,7 @@ from contextlib import contextmanager
 from functools import partial
 import time
 
-import gevent
+import gevent, gevent.event
 
 
 def set_interval(func, delay, now=False, *args, **kwargs):
@@ -30,3 +30,62 @@ def green_block(func, *args, **kwargs):
   g.kill()
 
 interval_block = partial(green_block, set_interval)
+
+
+class TokenBucket(object):
+  """Rate limiter that greenlets draw byte (or any unit) tokens from.
+
+  Callers may overdraw the bucket; they then sleep until the debt has been
+  refilled, so greenlets sharing a bucket together stay under the rate.
+  A rate of 0 means unlimited.
+  """
+  def __init__(self, rate=0, burst=None):
+    self.tokens = 0.0
+    self.stamp = time.time()
+    self.set_rate(rate, burst)
+
+  def set_rate(self, rate, burst=None):
+    self.refill()
+    self.rate = rate
+    self.burst = burst or rate
+    self.tokens = min(self.tokens, self.burst)
+
+  def refill(self):
+    now = time.time()
+    if self.rate:
+      self.tokens = min(self.burst,
+                        self.tokens + (now - self.stamp)*self.rate)
+    self.stamp = now
+
+  def consume(self, amount):
+    if not self.rate: return
+    self.refill()
+    self.tokens -= amount
+    if self.tokens < 0:
+      gevent.sleep(-self.tokens/self.rate)
+
+
+class SingleFlight(object):
+  """Coalesce concurrent calls with the same key into a single call.
+
+  While a call for a key is running, other callers of do() with that key wait
+  for it and get its result (or exception) instead of making their own.
+  """
+  def __init__(self):
+    self.calls = {}
+
+  def do(self, key, func, *args, **kwargs):
+    if key in self.calls:
+      return self.calls[key].get()
+
+    result = self.calls[key] = gevent.event.AsyncResult()
+    try:
+      value = func(*args, **kwargs)
+    except BaseException as e:  # Even a kill, so waiters don't hang.
+      result.set_exception(e)
+      raise
+    else:
+      result.set(value)
+      return value
+    finally:
+      del self.calls[key]
@@ -14,7 +14,7 @@ from gevent import monkey; __name__ == '__main__' and monkey.patch_all()
 from collections import namedtuple
 from contextlib import contextmanager
 from distutils.spawn import find_executable
-import hashlib
+import itertools
 import logging as log
 import os
 from gevent.queue import JoinableQueue as Queue
@@ -26,12 +26,16 @@ import subprocess
 import sys
 import time
 
-import gevent, gevent.event, gevent.pool
+import gevent, gevent.event, gevent.lock, gevent.pool, gevent.subprocess
+import putio as legacy_putio
 import putio2 as putio
 import requests
 import yaml
 
-from async import interval_block
+from async import SingleFlight, TokenBucket, set_interval
+import listing
+import scheduler
+import transfer
 from util import *
 
 
@@ -40,14 +44,36 @@ if not os.path.exists('cfg.yml'):
 CFG = AttrDict(yaml.load(open('cfg.yml', 'r')))
 
 log.root.setLevel(CFG.loglevel)
-episode_patterns = (
-    r'[Ss]?(\d{1,3})[.]?[Eex](\d{1,3})',
-    r' (\d{1,3})[x.](\d{1,3})',
-)
-episode_res = tuple(re.compile(p) for p in episode_patterns)
+# One pass finds the first of: an air date (2013.01.02), a season and
+# episode (S01E02, 1x02, and multi-episode S01E02E03 or S01E02-E03), or a
+# spaced " 1.02". Named groups tell which one matched.
+episode_re = re.compile(r'''
+    (?P<year>(?:19|20)\d\d)[. _-](?P<month>0[1-9]|1[0-2])[. _-]
+      (?P<day>0[1-9]|[12]\d|3[01])(?!\d)
+  | [Ss]?(?P<season>\d{1,3})[.]?[Eex](?P<episode>\d{1,3})(?!\d)
+      (?:-?[Ee](?P<last>\d{1,3})(?!\d))*
+  | \ (?P<alt_season>\d{1,3})[x.](?P<alt_episode>\d{1,3})(?!\d)
+''', re.X)
+# Wider "multi-episode" ranges are more likely a misread tag than real.
+max_episode_span = 5
 range_re = re.compile(r'bytes (\d+)-\d+/\d+')
 
 api = None
+legacy_api = None
+pool_size = CFG.io.get('pool') or CFG.io.max*CFG.io.get('segments', 1)
+session = requests.session(config={
+    'keep_alive': True,
+    'pool_connections': pool_size,
+    'pool_maxsize': pool_size,
+})
+retry = Backoff(**CFG.io.retry)
+breaker_cfg = CFG.io.get('breaker', {})
+breakers = Breakers(breaker_cfg.get('failures', 5), breaker_cfg.get('reset', 60))
+concurrency = scheduler.ConcurrencyController(
+    CFG.io.get('min', 1) if CFG.io.get('adapt') else CFG.io.max, CFG.io.max)
+cache_cfg = CFG.get('cache', {})
+listings = listing.ListingStore(cache_cfg.get('path', 'listings.db'),
+                                cache_cfg.get('max_age', 3600))
 converter_path = find_executable('avconv')
 convert_queue = Queue()
 check_now = gevent.event.Event()
@@ -63,6 +89,11 @@ events = AttrDict({
     'progress': noop,
 })
 
+# Shared by every download stream to enforce the overall bandwidth cap.
+bandwidth = TokenBucket()
+# Byte counters of running downloads, reported by a single sampler greenlet.
+active_progress = {}
+
 Download = namedtuple('Download', ('id', 'label', 'url', 'path', 'it'))
 
 if not os.access(converter_path, os.X_OK):
@@ -73,46 +104,162 @@ def load_api():
   global api, down_put_dir
   try:
     down_put_dir = None
-    api = putio.Client(CFG.putio.access_token)
+    api = putio.Client(CFG.putio.access_token, session, retry, breakers,
+                       SingleFlight())
   except putio.PutioError:
     api = None
 load_api()
 
+Episode = namedtuple('Episode', ('show', 'season', 'episodes', 'date',
+                                 'label', 'dir'))
+episodes = LRUCache(maxsize=CFG.get('cache', {}).get('episodes', 4096))
+
 def parse_episode(text):
-  for episode_re in episode_res:
-    match = episode_re.search(text)
-    if match:
-      season, episode = match.groups()
-      name = text[:match.start()]
-      name = name.replace('.', ' ').replace('_', ' ').strip(' _-.').title()
-      return name, int(season), int(episode)
-  return None
+  """Parse a name into an Episode, or None if it isn't one.
+
+  Date based episodes use the year as their season and MMDD as the episode.
+  dir is relative to the download folder.
+  """
+  match = episode_re.search(text)
+  if not match: return None
+  show = text[:match.start()]
+  show = show.replace('.', ' ').replace('_', ' ').strip(' _-.').title()
+  groups = match.groupdict()
+  if groups['year']:
+    date = '%s-%s-%s' % (groups['year'], groups['month'], groups['day'])
+    season = int(groups['year'])
+    numbers = (int(groups['month'] + groups['day']),)
+    label = '%s %s' % (show, date)
+  else:
+    date = None
+    season = int(groups['season'] or groups['alt_season'])
+    first = int(groups['episode'] or groups['alt_episode'])
+    last = int(groups['last'] or first)
+    if not first < last <= first + max_episode_span: last = first
+    numbers = tuple(range(first, last + 1))
+    label = '%s Season %.2d Episode %s' % (show, season, '-'.join(
+        '%.2d' % n for n in sorted(set((first, last)))))
+  return Episode(show, season, numbers, date, label,
+                 os.path.join(show, 'Season %.2d' % season))
+
+def episode_info(it):
+  """Return the parsed Episode for a put.io file, cached by id and name.
+
+  Files that aren't episodes get one with no show, filed under Videos.
+  """
+  key = it.id, it.name
+  info = episodes.get(key)
+  if info is LRUCache.missing:
+    info = (parse_episode(it.name) or
+            Episode(None, None, (), None, it.name, 'Videos'))
+    episodes.set(key, info)
+  return info
+
+def scheduled_rate(hour=None):
+  """Return the overall bandwidth cap for an hour of the day."""
+  rate = CFG.get('rate', {})
+  if hour is None: hour = time.localtime().tm_hour
+  for hours, limit in (rate.get('schedule') or {}).items():
+    first, last = [int(h) for h in str(hours).split('-')]
+    if (first <= hour < last if first <= last else
+        (hour >= first or hour < last)):
+      return limit
+  return rate.get('max', 0)
+
+def update_rate():
+  limit = scheduled_rate()
+  if limit != bandwidth.rate:
+    log.info('Bandwidth limit is now %s/s.',
+             human_size(limit) if limit else 'unlimited')
+    bandwidth.set_rate(limit)
+
+def report_progress():
+  """Emit progress events for every running download in one pass."""
+  for download, done, size in active_progress.values():
+    events.progress(download, done(), size)
+
+@contextmanager
+def track_progress(download, done, size):
+  """Have the sampler report done() as a download's progress while active."""
+  if download: active_progress[download.id] = download, done, size
+  try:
+    yield
+  finally:
+    if download: active_progress.pop(download.id, None)
 
 def episode_sort_key(it):
   """Extract season and episode from show titles for numeric sorting."""
-  parsed = parse_episode(it.name)
-  if not parsed: return it.name
-  name, season, episode = parsed
-  return season, episode
+  info = episode_info(it)
+  if info.show is None: return it.name
+  return info.season, info.episodes[0]
 
-def convert_video(path, out='stereo.m4v'):
+def convert_args(path, source=None, out='stereo.m4v'):
+  """Build the avconv remux command for path, reading from source if given."""
   path_name, ext = os.path.splitext(path)
   if ext == '.remuxed': path_name = path_name[:-4]
   dest = '%s.%s' % (path_name, out)
   params = ('-c:v copy -c:a aac -b:a 160k -aq 100 -ac 2 -f mp4 '
             '-map_chapters 0 -map_metadata 0 -strict experimental')
-  convert_cmd = [converter_path, '-y', '-i', path] + params.split() + [dest]
+  convert_cmd = ([converter_path, '-y', '-i', source or path] +
+                 params.split() + [dest])
+  return convert_cmd, dest
+
+def finish_convert(dest):
+  """Move a remuxed video from the download dir into the library."""
+  new_path = dest.replace(os.path.abspath(CFG.download.local),
+                          os.path.abspath(CFG.download.remux))
+  new_dir, new_name = os.path.split(new_path)
+  if not os.path.exists(new_dir):
+    log.info('Converted video dir "%s" not found, creating.', new_dir)
+    os.makedirs(new_dir)
+  transfer.move_file(dest, new_path)
+
+def convert_video(path):
+  convert_cmd, dest = convert_args(path)
   failed = subprocess.call(convert_cmd)
   if not failed:
-    new_path = dest.replace(os.path.abspath(CFG.download.local),
-                            os.path.abspath(CFG.download.remux))
-    new_dir, new_name = os.path.split(new_path)
-    if not os.path.exists(new_dir):
-      log.info('Converted video dir "%s" not found, creating.', new_dir)
-      os.makedirs(new_dir)
-    os.rename(dest, new_path)
+    finish_convert(dest)
   convert_queue.task_done()
 
+
+class LiveConvert(object):
+  """Remux a video while it downloads, by teeing the bytes into avconv.
+
+  Only a download streamed in order from its first byte can be fed, so if
+  any bytes are missed finish() reports failure and the caller falls back to
+  converting the finished file.
+  """
+  def __init__(self, path):
+    self.cmd, self.dest = convert_args(path, 'pipe:0')
+    self.proc = gevent.subprocess.Popen(self.cmd, stdin=subprocess.PIPE)
+    self.fed = 0
+    self.broken = False
+
+  def write(self, data):
+    if self.broken: return
+    try:
+      self.proc.stdin.write(data)
+      self.fed += len(data)
+    except (IOError, OSError):
+      self.broken = True  # avconv gave up, the download carries on.
+
+  def abort(self):
+    self.broken = True
+    if self.proc.poll() is None: self.proc.kill()
+
+  def finish(self, size):
+    """Wait for avconv and return True if it remuxed the whole file."""
+    if self.fed != size: self.abort()
+    try:
+      self.proc.stdin.close()
+    except (IOError, OSError):
+      self.broken = True
+    failed = self.proc.wait()
+    if failed or self.broken:
+      return False
+    finish_convert(self.dest)
+    return True
+
 def convert(*args, **kwargs):
   convert_queue.put(*args, **kwargs)
   if CFG.io.max == 1:
@@ -123,84 +270,306 @@ def convert_worker():
     path = convert_queue.get()
     gevent.spawn(convert_video, path)
 
-@memoize(15)
-def list_files_raw(parent):
-  return api.File.list(parent_id=parent)
-
-def list_files(kind=None, parent=0, name=None):
-  files = list_files_raw(parent)
-  if kind == 'folder': kind = 'application/x-directory'
-  return [f for f in files if
-          (not kind or f.content_type.startswith(kind)) and
-          (not name or f.name == name)]
-
-def get_all_videos(parent=0):
-  """Put.io's api is a bit broken, so manually find all videos recursively."""
-  videos = []
-  try:
-    videos.extend(list_files(kind='video', parent=parent))
-  except putio.PutioError: pass
+# Failures worth riding out on a stale result while it is refreshed.
+api_errors = putio.PutioError, requests.exceptions.RequestException
 
+@memoize(15, maxsize=1024, stale=CFG.get('cache', {}).get('stale', 600),
+         errors=api_errors)
+def list_files_raw(parent):
+  return listing.Listing(api.File.list(parent_id=parent))
+
+# The GUI polls this, and shows it at once from the cache while an expired
+# one refreshes in the background (via .stale).
+@memoize(15, maxsize=1, stale=CFG.get('cache', {}).get('stale', 600),
+         errors=api_errors)
+def account_info():
+  return api.Account.info()
+
+def list_files(kind=None, parent=0, name=None, stale=False):
+  """List a folder's files of a kind or name, maybe from a stale listing."""
+  if kind == 'folder': kind = listing.FOLDER
+  raw = list_files_raw.stale if stale else list_files_raw
+  return raw(parent).find(kind, name or None)
+
+def load_tree():
+  """Fetch the whole folder hierarchy in one legacy api dirmap call."""
+  global legacy_api
+  if not CFG.watch.get('dirmap'): return None
   try:
-    for subdir in list_files(kind='folder', parent=parent):
-      videos.extend(get_all_videos(parent=subdir.id))
-  except putio.PutioError: pass
+    if not legacy_api:
+      legacy_api = legacy_putio.Api(CFG.putio.api_key, CFG.putio.api_secret)
+    return listing.FolderTree(legacy_api.get_folder_tree())
+  except legacy_putio.PutioError as e:
+    log.warning('Could not map put.io folders, listing them instead: %s.', e)
+    return None
+
+def get_all_videos(parent=0, max_depth=None, signature=None):
+  """Put.io's api is a bit broken, so manually find all videos recursively.
+
+  Sibling folders are listed concurrently, at most watch.listings at a time,
+  down to max_depth levels below parent. A folder that fails to list is
+  logged and skipped without losing what was found elsewhere. Folders whose
+  signature matches the listing store are read from it instead of put.io.
+  """
+  if max_depth is None: max_depth = CFG.watch.get('depth', 10)
+  limit = gevent.lock.BoundedSemaphore(CFG.watch.get('listings', 8))
+  group = gevent.pool.Group()
+  videos = []
 
+  def visit(folder_id, sig, depth):
+    try:
+      if listings.is_fresh(folder_id, sig):
+        files = listing.Listing(api.File(f)
+                                for f in listings.children(folder_id))
+      else:
+        with limit:
+          files = list_files_raw(folder_id)
+        listings.update(folder_id, sig, files)
+    except (putio.PutioError, requests.exceptions.RequestException) as e:
+      log.warning('Could not list put.io folder %s: %s.', folder_id, e)
+      return
+
+    videos.extend(files.find(kind='video'))
+    if depth < max_depth:
+      for f in files.find(kind=listing.FOLDER):
+        group.spawn(visit, f.id, listing.signature(f), depth + 1)
+
+  visit(parent, signature, 0)
+  group.join()
   return videos
 
-def fetch_to_file(url, path, size=None, download=None):
-  """Do the low-level transfer from a url to a file, supporting resume."""
-  chunk_size = CFG.io.chunk
-
-  start = 0
-  if size and os.path.exists(path):
-    start = os.path.getsize(path)
-    if start == size:
-      log.info('Already finished "%s"! Skipping.', path)
-      return True
-    log.info('Found %s already downloaded, resuming.', human_size(start))
-
-  params = {
+def request_params(start=0, end=None):
+  """Build the requests kwargs for a (possibly partial) download request."""
+  byte_range = 'bytes=%d-%s' % (start, '' if end is None else end)
+  return {
       'params': {'access_token': CFG.putio.access_token},
       'prefetch': False,
-      'headers': {'Range': 'bytes=%d-' % start, 'User-Agent': CFG.user_agent},
+      'headers': {'Range': byte_range, 'User-Agent': CFG.user_agent},
       'verify': False,
   }
 
+def fetch_range(url, path, first, last, record, received, index, throttle,
+                checksum=None, tee=None):
+  """Fetch one byte range of a url into the same offsets of a local file.
+
+  Written bytes are synced to disk, dropped from the page cache and passed to
+  record() every io.fsync seconds, and once more when the range ends or fails,
+  so they never need refetching. Every chunk is passed to throttle() before
+  being read, to limit bandwidth, and fed to checksum and tee as it is written.
+  """
+  sync_every = CFG.io.get('fsync', 0)
+  breaker = breakers(url)
+  if not breaker.allow():
+    log.warning('Skipping "%s" while its server is failing.', path)
+    return False
+
   try:
-    response = requests.get(url, **params)
-    if response.status_code not in (200, 206):
+    try:
+      response = session.get(url, **request_params(first, last))
+    except requests.exceptions.RequestException:
+      breaker.failure()
+      concurrency.failure()
+      raise
+    if response.status_code >= 500:
+      breaker.failure()
+      concurrency.failure()
+    else:
+      breaker.success()
+      concurrency.success()
+    match = range_re.match(response.headers.get('content-range', ''))
+    if response.status_code == 200 and first == 0:
+      pass  # Server sent the whole file, which is just as good from 0.
+    elif response.status_code != 206:
       log.error('Bad status code %d for "%s".', response.status_code, url)
       return False
+    elif not match or int(match.group(1)) != first:
+      log.error('Server ignored range %d-%s for "%s".', first, last, url)
+      return False
 
-    match = range_re.match(response.headers.get('content-range', ''))
-    if match:
-      server_start = int(match.group(1))
-      if server_start != start:
-        log.warning('Server returned unexpected range: %d.', server_start)
-        start = min(start, server_start)  # Avoid seeking past end of file
-
-    with open(path, 'ab') as dl_file:
-      def progress():
-        try:
-          cursize = os.path.getsize(path) if dl_file.closed else dl_file.tell()
-          (download and events.progress)(download, cursize, size)
-        except OSError:
-          return False
-
-      with interval_block(progress, 0.25):
-        shutil.copyfileobj(response.raw, dl_file, chunk_size)
+    with open(path, 'r+b') as dl_file:
+      dl_file.seek(first)
+      fd = dl_file.fileno()
+      state = {'pos': first, 'synced': first, 'synced_at': time.time()}
+
+      def sync():
+        synced, pos = state['synced'], state['pos']
+        dl_file.flush()
+        transfer.datasync(fd)
+        transfer.drop_cache(fd, synced, pos - synced)
+        record(synced, pos - 1)
+        state.update(synced=pos, synced_at=time.time())
+
+      def wrote(data):
+        count = len(data)
+        if checksum: checksum.update(first, data)
+        if tee: tee.write(data)
+        concurrency.record(count)
+        state['pos'] += count
+        received[index] += count
+        if sync_every and time.time() - state['synced_at'] >= sync_every:
+          sync()
+
+      try:
+        amount = None if last is None else last - first + 1
+        copier = transfer.Copier(CFG.io.chunk,
+                                 CFG.io.get('chunk_max', CFG.io.chunk))
+        copier.copy(response.raw, dl_file, amount, throttle, wrote)
+      finally:
+        sync()
 
   except requests.exceptions.RequestException as re:
     log.error('Error downloading "%s": %s.', path, re)
     return False
 
-  return (os.path.getsize(path) == size) if size else True
+  return last is None or state['pos'] == last + 1
+
+def fetch_window(url, first, last):
+  """Return bytes first through last of a url, or None if unavailable."""
+  try:
+    response = session.get(url, **request_params(first, last))
+  except requests.exceptions.RequestException as re:
+    log.warning('Could not fetch bytes %d-%d of "%s": %s.', first, last, url, re)
+    return None
+  match = range_re.match(response.headers.get('content-range', ''))
+  if response.status_code != 206 or not match or int(match.group(1)) != first:
+    return None
+  return response.content
+
+def verify_resume(url, path, journal, size, window):
+  """Compare the bytes before each resume point with the server's.
+
+  Where they differ, the journal is cut back to the last matching byte, with
+  the window doubling backwards while nothing matches, so corrupt tails are
+  refetched instead of trusted.
+  """
+  with open(path, 'rb') as dl_file:
+    for first, last in list(journal.ranges):
+      if last + 1 >= size: continue  # Nothing after this range to resume.
+      end, span = last, window
+      while end >= first:
+        lo = max(first, end - span + 1)
+        remote = fetch_window(url, lo, end)
+        if remote is None:
+          log.warning('Could not verify resume point of "%s".', path)
+          return
+        dl_file.seek(lo)
+        local = dl_file.read(end - lo + 1)
+        same = next((i for i, (a, b) in enumerate(zip(local, remote))
+                     if a != b), min(len(local), len(remote)))
+        if same == end - lo + 1: break
+        log.warning('Local bytes %d-%d of "%s" differ from the server.',
+                    lo + same, end, path)
+        journal.discard(lo + same, last)
+        if same: break
+        end, span = lo - 1, span*2
+
+def fetch_to_file(url, path, size=None, download=None, crc=None, tee=None):
+  """Do the low-level transfer from a url to a file, supporting resume.
+
+  The file is preallocated to its full size and completed ranges are tracked
+  in a sidecar journal, so after a crash only the missing ranges are fetched,
+  once the bytes just before each gap are checked against the server.
+  Large files are split into io.segments ranges fetched concurrently.
+
+  If crc is given, the crc32 is computed as bytes arrive (and over already
+  downloaded ranges before each attempt) and the file is refetched on
+  mismatch.
+  If tee is given and nothing is downloaded yet, the file is fetched in order
+  in a single stream and every byte is also passed to tee.write().
+  """
+  if not size:
+    open(path, 'wb').close()
+    return fetch_range(url, path, 0, None, noop, [0], 0, bandwidth.consume)
+
+  journal = transfer.Journal(path)
+  if not os.path.exists(path):
+    journal.remove()  # The data it vouched for is gone.
+  elif not journal.exists():
+    start = os.path.getsize(path)
+    if start == size:
+      log.info('Already finished "%s"! Skipping.', path)
+      return True
+    journal.create()
+    if start < size:
+      # Left over from a plain sequential download; verify_resume checks it.
+      journal.add(0, start - 1)
+    else:
+      open(path, 'wb').close()  # Bigger than expected, so start over.
+  journal.create()
+  # Ranges past the end of a truncated file aren't on disk after all.
+  on_disk = os.path.getsize(path) if os.path.exists(path) else 0
+  if journal.ranges and journal.ranges[-1][1] >= on_disk:
+    journal.discard(on_disk, journal.ranges[-1][1])
+
+  window = CFG.io.get('verify', 0)
+  if window and journal.ranges:
+    verify_resume(url, path, journal, size, window)
+
+  start = journal.completed()
+  if start:
+    log.info('Found %s already downloaded, resuming.', human_size(start))
+
+  checksum = None
+  if crc:
+    checksum = transfer.Checksum()
+    if isinstance(crc, basestring): crc = int(crc, 16)
+
+  with open(path, 'r+b' if os.path.exists(path) else 'wb') as dl_file:
+    transfer.preallocate(dl_file.fileno(), size)
+    if checksum:
+      for first, last in journal.ranges:
+        checksum.read(dl_file, first, last)
+
+  segments = CFG.io.get('segments', 1)
+  if size < CFG.io.get('segment_min', 0): segments = 1
+  if tee and journal.ranges: tee = None
+  if tee: segments = 1
+  ranges = transfer.split_ranges(journal.missing(size), segments)
+  if len(ranges) > 1:
+    log.info('Fetching "%s" in %d segments.', path, len(ranges))
+
+  received = [0]*len(ranges)
+
+  limit = TokenBucket(CFG.get('rate', {}).get('download', 0))
+  def throttle(amount):
+    limit.consume(amount)
+    bandwidth.consume(amount)
+
+  pool = gevent.pool.Pool(size=segments)
+  with track_progress(download, lambda: start + sum(received), size):
+    for i, (first, last) in enumerate(ranges):
+      pool.spawn(fetch_range, url, path, first, last, journal.add, received, i,
+                 throttle, checksum, tee)
+    pool.join()
+
+  missing = journal.missing(size)
+  if missing:
+    log.error('%d ranges of "%s" still missing.', len(missing), path)
+    return False
+
+  if checksum and checksum.value(size) != crc:
+    log.error('Checksum mismatch for "%s", refetching.', path)
+    journal.remove()
+    journal.create()
+    return False
+
+  journal.remove()
+  return True
+
+def resolve_url(it, refresh=False):
+  """Return a file's signed download url, looking it up again if asked."""
+  if refresh and hasattr(it, '_download_url'):
+    del it._download_url
+  try:
+    return it.download_url
+  except (putio.PutioError, KeyError, requests.exceptions.RequestException) as e:
+    log.error('No download url for "%s", put.io API issue: %s.', it.name, e)
+    return None
 
 def fetch(download):
   """Manage the download from put.io, then move to downloaded folder."""
   file_id, label, url, path, it = download
-  log.info('Downloading %s from "%s" to "%s".', label, url, path)
+  log.info('Downloading %s to "%s".', label, path)
 
   file_dir, file_name = os.path.split(path)
   if not os.path.exists(file_dir):
@@ -209,34 +578,101 @@ def fetch(download):
 
   (download and events.init)(download)
 
-  success, max_tries = False, CFG.io.retry.count
-  for tries in xrange(1, max_tries + 1):
+  path_name, ext = os.path.splitext(path)
+  remux = CFG.download.remux and ext in ('.mkv',)
+  live = None
+  if remux and CFG.download.get('live') and not os.path.exists(path):
+    live = LiveConvert(path)
+
+  success, delays = False, retry.delays()
+  for tries in itertools.count(1):
+    # Signed urls expire, so every retry looks the url up again.
+    url = resolve_url(it, refresh=tries > 1)
     log.info('Download attempt #%d of "%s".', tries, url)
     (download and events.status)(download, 'downloading')
 
-    if fetch_to_file(url, path, int(it.size), download):
+    # Only the first attempt starts from scratch, so only it can feed avconv.
+    if url and fetch_to_file(url, path, int(it.size), download,
+                             getattr(it, 'crc32', None),
+                             tries == 1 and live or None):
       success = True
       break
+    if live: live.abort()
 
     (download and events.status)(download, 'pending')
-    time.sleep(CFG.io.retry.delay)
+    delay = next(delays, None)
+    if delay is None: break
+    log.info('Retrying "%s" in %.1f seconds.', file_name, delay)
+    time.sleep(delay)
 
   if not success:
+    if live: live.finish(int(it.size))
     log.info('Completely failed to download "%s".', file_name)
     (download and events.status)(download, 'failed')
     return False
 
-  path_name, ext = os.path.splitext(path)
-  if CFG.download.remux and ext in ('.mkv',):
+  if remux:
     (download and events.status)(download, 'converting')
-    convert(path)
+    if not (live and live.finish(int(it.size))):
+      if live: log.info('Live remux of "%s" failed, converting.', file_name)
+      convert(path)
 
   (download and events.status)(download, 'moving')
-  it.move(down_put_dir.id)
+  moves.add(it, down_put_dir.id)
   log.info('Successfully downloaded "%s".', file_name)
   (download and events.status)(download, 'completed')
   return True
 
+class MoveBatcher(object):
+  """Collect finished files and move them on put.io in batched calls.
+
+  Files are flushed once size of them are pending, or delay seconds after
+  the first one arrived. If a batch move fails, each file is moved alone.
+  """
+  def __init__(self, size=20, delay=5):
+    self.size = size
+    self.delay = delay
+    self.pending = {}
+    self.timer = None
+
+  def add(self, it, parent_id):
+    self.pending.setdefault(parent_id, []).append(it)
+    if sum(len(files) for files in self.pending.values()) >= self.size:
+      self.flush()
+    elif not self.timer:
+      self.timer = gevent.spawn_later(self.delay, self.flush)
+
+  def flush(self):
+    if self.timer and self.timer is not gevent.getcurrent():
+      self.timer.kill()
+    self.timer = None
+    pending, self.pending = self.pending, {}
+
+    for parent_id, files in pending.items():
+      moved = files
+      try:
+        api.File.move_many([f.id for f in files], parent_id)
+      except (putio.PutioError, requests.exceptions.RequestException) as e:
+        log.warning('Moving %d files failed (%s), moving one at a time.',
+                    len(files), e)
+        moved = []
+        for f in files:
+          try:
+            f.move(parent_id)
+            moved.append(f)
+          except (putio.PutioError, requests.exceptions.RequestException):
+            log.error('Could not move "%s" on put.io.', f.name)
+
+      # Their old folders' signatures may not change, so the stored listings
+      # would keep offering the moved files until they expire.
+      listings.forget([f.id for f in moved])
+      list_files_raw.invalidate(parent_id)
+      for f in files:
+        list_files_raw.invalidate(getattr(f, 'parent_id', 0))
+
+moves = MoveBatcher(CFG.download.get('move_batch', 20),
+                    CFG.download.get('move_delay', 5))
+
 def fetch_new():
   """Check for new video files in the put.io root folder and download."""
   global down_put_dir
@@ -245,7 +681,8 @@ def fetch_new():
     return 0
   if not down_put_dir:
     try:
-      down_put_dir = list_files(kind='folder', name=down_put_path)[0]
+      down_put_dir = list_files(kind='folder', name=down_put_path,
+                                stale=True)[0]
       log.info('%s folder already in put.io, reusing.', down_put_path)
     except (putio.PutioError, IndexError):
       down_put_dir = api.File.create_folder(down_put_path)
@@ -261,50 +698,67 @@ def fetch_new():
   except (putio.PutioError, requests.exceptions.RequestException):
     items = []
 
+  priorities = CFG.watch.get('priority') or {}
+  item_priority = {}
+  tree = load_tree()
   for folder_name in CFG.watch.putio:
     try:
-      folder = list_files(kind='folder', name=folder_name)[0]
-      sub_items = get_all_videos(folder.id)
+      folder_id = tree and tree.find(folder_name)
+      if folder_id is not None:
+        # The tree only resolves the path. The folder's entry in its parent
+        # still supplies the signature that lets the store skip relisting.
+        folder = list_files_raw(tree.parents[folder_id]).get(folder_id)
+      else:
+        folder = list_files(kind='folder', name=folder_name)[0]
+        folder_id = folder.id
+      sub_items = get_all_videos(folder_id, signature=folder and
+                                 listing.signature(folder))
       if not sub_items:
         # Confirm that it's really empty.
         try:
-          all_sub_items = list_files(parent=folder.id)
+          all_sub_items = list_files(parent=folder_id)
         except (putio.PutioError, requests.exceptions.RequestException):
           log.info('Removing empty folder from watch folder: %s.', folder_name)
           #folder.delete_item()
 
       items.extend(sub_items)
+      for it in sub_items:
+        item_priority[it.id] = priorities.get(folder_name, 0)
     except (putio.PutioError, IndexError):
       down_put_dir = api.File.create_folder(down_put_path)
       log.warning('%s watch folder not found.', folder_name) 
     except requests.exceptions.RequestException:
       log.warning('Connection error to put.io.')
 
-  # Sort by season and episode across all shows.
+  added, removed = listings.take_changes()
+  if added or removed:
+    log.info('Watch folders changed: %d files new, %d gone.',
+             len(added), len(removed))
+
+  # Sort by season and episode across all shows, as the final tie-breaker.
   items.sort(key=episode_sort_key)
+  queue = scheduler.DownloadQueue(
+      CFG.get('schedule', {}).get('policy') or ['priority'])
 
   for it in items:
-    name = it.name
-    parsed = parse_episode(it.name)
-    if parsed:
-      name, season, episode = parsed
-      season, episode = '%.2d' % season, '%.2d' % episode
-      file_dir = os.path.join(down_path, name, 'Season %s' % season)
-      label = '%s Season %s Episode %s' % (name, season, episode)
-    else:
-      file_dir = os.path.join(down_path, 'Videos')
-      label = name
+    info = episode_info(it)
+    name = info.show or it.name
+    file_dir = os.path.join(down_path, info.dir)
+    label = info.label
 
+    # The download url is resolved by fetch, once the download has a slot.
     file_path = os.path.join(file_dir, it.name)
-    if not it.download_url:
-      log.error('Empty download url for %s, put.io API issue.', label)
-      continue
+    file_id = 'file:%s' % it.id
+    download = Download(file_id, label, '', file_path, it)
+    queue.put(download, priority=item_priority.get(it.id, 0), show=name,
+              size=int(it.size), created=getattr(it, 'created_at', None))
 
-    file_id = hashlib.md5(it.download_url)
-    download = Download(file_id, label, it.download_url, file_path, it)
-    g = pool.spawn(fetch, download)
+  while queue:
+    concurrency.wait(pool)
+    pool.spawn(fetch, queue.get())
 
   pool.join()
+  moves.flush()
   return len(items)
 
 
@@ -354,6 +808,10 @@ def main():
 
   minutes = CFG.poll.downloads/60
   gevent.spawn(convert_worker)
+  set_interval(update_rate, 60, now=True)
+  set_interval(report_progress, CFG.poll.get('progress', 0.25))
+  if CFG.io.get('adapt'):
+    set_interval(concurrency.adjust, CFG.io.adapt)
 
   while True:
     try:
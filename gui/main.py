@@ -180,7 +180,7 @@ def main():
     app.root.free_space_local = fetcher.human_size(local)
     if not fetcher.api: return
     try:
-      info = fetcher.api.Account.info()
+      info = fetcher.account_info.stale()
       if info:
         remote = info.disk['avail']
         app.root.free_space_remote = fetcher.human_size(remote)
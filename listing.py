@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""Indexed put.io folder listings, and a persistent store to avoid relisting."""
+
+__author__ = 'adam@adamia.com (Adam R. Smith)'
+
+from collections import defaultdict
+import datetime
+import json
+import sqlite3
+import time
+
+
+FOLDER = 'application/x-directory'
+
+def signature(folder):
+  """Summarize what a folder's entry in its parent says about its contents."""
+  return '%s:%s' % (getattr(folder, 'size', ''),
+                    getattr(folder, 'updated_at', ''))
+
+def _is_kind(f, kind):
+  """Whether a file's content type is kind, or has kind as its major type."""
+  content_type = f.content_type or ''
+  return content_type == kind or content_type.split('/')[0] == kind
+
+def _encode(value):
+  if isinstance(value, datetime.datetime): return value.isoformat()
+  raise TypeError(repr(value))
+
+
+class Listing(list):
+  """A folder's files, indexed by id, name and content type when built.
+
+  Content types are indexed both whole and by their major type, so a kind
+  like 'video' or 'application/x-directory' is found without a scan.
+  """
+  def __init__(self, files=()):
+    list.__init__(self, files)
+    self.by_id = {}
+    self.by_name = defaultdict(list)
+    self.by_type = defaultdict(list)
+    for f in self:
+      self.by_id[f.id] = f
+      self.by_name[f.name].append(f)
+      content_type = f.content_type or ''
+      self.by_type[content_type].append(f)
+      major = content_type.split('/')[0]
+      if major != content_type: self.by_type[major].append(f)
+
+  def get(self, file_id):
+    return self.by_id.get(file_id)
+
+  def find(self, kind=None, name=None):
+    """Return files of a major or full content type kind, named name."""
+    if name is not None:
+      files = self.by_name.get(name, [])
+      if kind: files = [f for f in files if _is_kind(f, kind)]
+      return list(files)
+    if kind:
+      return list(self.by_type.get(kind, ()))
+    return list(self)
+
+
+class FolderTree(object):
+  """The whole put.io folder hierarchy, from a single dirmap call.
+
+  Folders are keyed by id, with links to their parent and children, and can
+  be looked up by a slash separated path from the root (id 0).
+  """
+  def __init__(self, dirs):
+    self.names = {0: ''}
+    self.parents = {}
+    self.children = defaultdict(list)
+    pending = [(0, d) for d in dirs]
+    while pending:
+      parent_id, folder = pending.pop()
+      folder_id = int(folder['id'])
+      self.names[folder_id] = folder['name']
+      self.parents[folder_id] = parent_id
+      self.children[parent_id].append(folder_id)
+      pending.extend((folder_id, d) for d in folder.get('dirs') or ())
+
+  def __contains__(self, folder_id):
+    return folder_id in self.names
+
+  def find(self, path, parent=0):
+    """Return the id of the folder at path below parent, or None."""
+    folder_id = parent
+    for name in path.strip('/').split('/'):
+      folder_id = next((child for child in self.children[folder_id]
+                        if self.names[child] == name), None)
+      if folder_id is None: return None
+    return folder_id
+
+  def path(self, folder_id):
+    names = []
+    while folder_id:
+      names.append(self.names[folder_id])
+      folder_id = self.parents[folder_id]
+    return '/'.join(reversed(names))
+
+
+class ListingStore(object):
+  """SQLite store of folder contents, keyed by folder id.
+
+  A folder is only relisted when its signature in a fresh parent listing no
+  longer matches the one stored with its contents, or when those contents
+  are older than max_age seconds. Updates record which file ids appeared and
+  disappeared, collected in added/removed until take_changes().
+
+  The database is only opened (and created) on first use.
+  """
+  def __init__(self, path, max_age=3600):
+    self.path = path
+    self.max_age = max_age
+    self.added, self.removed = set(), set()
+    self._db = None
+
+  @property
+  def db(self):
+    if self._db is None:
+      db = sqlite3.connect(self.path)
+      with db:
+        db.execute('CREATE TABLE IF NOT EXISTS folders ('
+                   'id INTEGER PRIMARY KEY, signature TEXT, listed_at REAL)')
+        db.execute('CREATE TABLE IF NOT EXISTS files ('
+                   'id INTEGER PRIMARY KEY, parent_id INTEGER, data TEXT)')
+        db.execute('CREATE INDEX IF NOT EXISTS files_parent '
+                   'ON files (parent_id)')
+      self._db = db
+    return self._db
+
+  def is_fresh(self, folder_id, sig):
+    """Whether the stored contents of a folder can be used as-is."""
+    if sig is None: return False
+    row = self.db.execute('SELECT signature, listed_at FROM folders '
+                          'WHERE id = ?', (folder_id,)).fetchone()
+    return bool(row and row[0] == sig and
+                (not self.max_age or time.time() - row[1] < self.max_age))
+
+  def children(self, folder_id):
+    """Return the stored file dicts inside a folder."""
+    rows = self.db.execute('SELECT data FROM files WHERE parent_id = ?',
+                           (folder_id,))
+    return [json.loads(data) for data, in rows]
+
+  def update(self, folder_id, sig, files):
+    """Replace the stored contents of a folder with a fresh listing."""
+    old_ids = set(file_id for file_id, in self.db.execute(
+        'SELECT id FROM files WHERE parent_id = ?', (folder_id,)))
+    new_ids = set(f.id for f in files)
+    self.added.update(new_ids - old_ids)
+    self.removed.update(old_ids - new_ids)
+
+    with self.db:
+      self._forget(old_ids - new_ids)
+      self.db.executemany(
+          'INSERT OR REPLACE INTO files (id, parent_id, data) VALUES (?, ?, ?)',
+          [(f.id, folder_id, self.dumps(f)) for f in files])
+      self.db.execute('INSERT OR REPLACE INTO folders (id, signature, '
+                      'listed_at) VALUES (?, ?, ?)',
+                      (folder_id, sig, time.time()))
+
+  def forget(self, file_ids):
+    """Drop files, and the stored contents of any that were folders."""
+    with self.db:
+      self._forget(file_ids)
+
+  def _forget(self, file_ids):
+    pending = list(file_ids)
+    while pending:
+      file_id = pending.pop()
+      pending.extend(child_id for child_id, in self.db.execute(
+          'SELECT id FROM files WHERE parent_id = ?', (file_id,)))
+      self.db.execute('DELETE FROM files WHERE id = ?', (file_id,))
+      self.db.execute('DELETE FROM folders WHERE id = ?', (file_id,))
+
+  @staticmethod
+  def dumps(f):
+    # Underscored attributes are local caches (like signed urls), not data.
+    data = dict((k, v) for k, v in f.__dict__.items() if not k.startswith('_'))
+    return json.dumps(data, default=_encode)
+
+  def take_changes(self):
+    """Return and reset the (added, removed) file ids since the last call."""
+    changes = self.added, self.removed
+    self.added, self.removed = set(), set()
+    return changes
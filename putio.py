@@ -69,6 +69,7 @@
 
 import sys
 import socket
+import threading
 import urllib
 import urllib2
 
@@ -473,6 +474,7 @@ class Api(object):
     Api Methods:
         
         api.get_items()
+        api.iter_items()
         api.get_transfers()
         api.get_user()
         api.is_ready()
@@ -581,7 +583,21 @@ class Api(object):
         
         """
         
-        items = []
+        items = self._list_items(limit, offset, parent_id, **arguments)
+        
+        if items:
+            self.update_user_token()
+            return items
+        else:
+            raise PutioError("You have no items to show.")
+    
+    
+    def _list_items(self, limit, offset, parent_id, **arguments):
+        """
+        Internal method for getting one page of items, which may be empty.
+        
+        """
+        
         args = {"limit":limit, "offset":offset, "parent_id":parent_id}
         
         for k,v in arguments.iteritems(): args[k] = v
@@ -590,16 +606,71 @@ class Api(object):
             args['type'] = Item._filetype_to_int(arguments["type"])
         
         result = _send(self.api, path="/files", post=args, method="list")
+        return [Item(self.api, r) for r in result or []]
+    
+    
+    def iter_items(self, page_size=100, max_items=None, prefetch=True,
+                   parent_id=0, **arguments):
+        """
+        Takes  : Item attributes [Optional], as for get_items()
+        Returns: A generator of Item objects, across all pages
         
-        if result:
-            self.update_user_token()
+        Pages through the items page_size at a time, so a large folder can be
+        processed as a stream in constant memory. With prefetch on, the next
+        page is requested in the background while the current one is being
+        consumed. Iteration stops after max_items items, or whenever the
+        caller stops asking for more.
+        
+        Example:
+        >>> for i in api.iter_items(parent_id=123, type="video"):
+        >>>     print i.name
+        
+        """
+        
+        def fetch(offset, holder):
+            try:
+                holder.append(self._list_items(page_size, offset, parent_id,
+                                               **arguments))
+            except Exception, e:
+                holder.append(e)
+        
+        def start(offset):
+            holder = []
+            if not prefetch:
+                fetch(offset, holder)
+                return None, holder
+            thread = threading.Thread(target=fetch, args=(offset, holder))
+            thread.daemon = True
+            thread.start()
+            return thread, holder
+        
+        def result(pending):
+            thread, holder = pending
+            if thread: thread.join()
+            if isinstance(holder[0], Exception): raise holder[0]
+            return holder[0]
+        
+        offset, count = 0, 0
+        pending = start(offset)
+        while True:
+            page = result(pending)
+            offset += page_size
+            more = len(page) == page_size and (
+                max_items is None or count + len(page) < max_items)
+            if more and prefetch:
+                pending = start(offset)
             
-            for r in result: 
-                items.append(Item(self.api, r))
+            if page and not count: self.update_user_token()
+            for item in page:
+                if max_items is not None and count >= max_items:
+                    return
+                count += 1
+                yield item
             
-            return items
-        else:
-            raise PutioError("You have no items to show.")
+            if not more:
+                return
+            if not prefetch:
+                pending = start(offset)
     
     
     def get_transfers(self):
@@ -833,6 +904,19 @@ class Api(object):
             return None
     
     
+    def get_folder_tree(self):
+        """
+        Takes  : Nothing
+        Returns: An Array of folder dicts, each with its sub folders in 'dirs'
+        
+        Same single dirmap call as get_folder_list(), but keeps the tree.
+        
+        """
+        
+        result = _send(self, path="/files", post={}, method="dirmap")
+        return result['dirs'] if result else []
+    
+    
     def get_user_info(self):
         """
         Takes  : Nothing
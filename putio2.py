@@ -24,6 +24,7 @@ import os
 import re
 import json
 import logging
+import time
 from urllib import urlencode
 
 import requests
@@ -71,8 +72,17 @@ class AuthHelper(object):
 
 class Client(object):
     
-    def __init__(self, access_token):
+    def __init__(self, access_token, session=None, retry=None, breakers=None,
+                 flights=None):
         self.access_token = access_token
+        # Share a session to reuse keep-alive connections across requests.
+        self.session = session or requests.session()
+        # retry.delays() yields waits between attempts of failed GETs, and
+        # breakers(url) returns a circuit breaker guarding the url's host.
+        self.retry = retry
+        self.breakers = breakers
+        # flights.do(key, func, *args) runs concurrent identical GETs once.
+        self.flights = flights
 
         # Keep resource classes as attributes of client.
         # Pass client to resource classes so resource object
@@ -84,10 +94,21 @@ class Client(object):
     
     def request(self, path, method='GET', params=None, data=None, files=None, headers=None, raw=False, allow_redirects=True):
         '''
-        Wrapper around requests.request()
+        Coalesces identical JSON GETs in flight, then calls _request().
+        '''
+        args = (path, method, params, data, files, headers, raw, allow_redirects)
+        if self.flights and method == 'GET' and not raw:
+            key = (path, tuple(sorted((params or {}).items())))
+            return self.flights.do(key, self._request, *args)
+        return self._request(*args)
+
+    def _request(self, path, method='GET', params=None, data=None, files=None, headers=None, raw=False, allow_redirects=True):
+        '''
+        Wrapper around Session.request()
 
         Prepends API_URL to path.
         Inserts oauth_token to query params.
+        Retries failed GETs and skips requests while the circuit is open.
         Parses response as JSON and returns it.
 
         '''
@@ -99,7 +120,30 @@ class Client(object):
         url = API_URL + path
         logger.debug('url: %s', url)
         
-        r = requests.request(method, url, params=params, data=data, files=files, headers=headers, allow_redirects=allow_redirects)
+        breaker = self.breakers and self.breakers(url)
+        delays = iter(())
+        if self.retry and method == 'GET':
+            delays = self.retry.delays()
+
+        while True:
+            if breaker and not breaker.allow():
+                raise PutioError('Skipping request to %s, put.io is failing' % path)
+            try:
+                r = self.session.request(method, url, params=params, data=data, files=files, headers=headers, allow_redirects=allow_redirects)
+                failed = r.status_code >= 500
+            except requests.exceptions.RequestException as e:
+                r, failed, error = None, True, e
+
+            if breaker:
+                breaker.failure() if failed else breaker.success()
+            delay = next(delays, None) if failed else None
+            if delay is None:
+                break
+            logger.debug('retrying %s in %.1fs', url, delay)
+            time.sleep(delay)
+
+        if r is None:
+            raise error
         logger.debug('response: %s', r)
         
         if raw:
@@ -201,6 +245,12 @@ class _File(_BaseResource):
         data = {'file_ids': self.id, 'parent_id': parent_id}
         return self.client.request('/files/move', 'POST', data=data)
 
+    @classmethod
+    def move_many(cls, file_ids, parent_id):
+        '''Move several files into parent_id with a single request'''
+        data = {'file_ids': ','.join(str(i) for i in file_ids), 'parent_id': parent_id}
+        return cls.client.request('/files/move', 'POST', data=data)
+
     @classmethod
     def get(cls, id):
         d = cls.client.request('/files/%i' % id, method='GET')
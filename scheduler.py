@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""Decide which pending download gets the next free download slot."""
+
+__author__ = 'adam@adamia.com (Adam R. Smith)'
+
+from collections import defaultdict, namedtuple
+import itertools
+import logging as log
+import time
+
+import gevent
+
+
+Job = namedtuple('Job', ('download', 'priority', 'show', 'size', 'created',
+                         'order'))
+
+# Each policy maps a job to a sort key, given how many jobs of each show have
+# already been handed out. Lower keys go first.
+POLICIES = {
+    'priority': lambda job, served: -job.priority,
+    'smallest': lambda job, served: job.size,
+    'round_robin': lambda job, served: served[job.show],
+    'oldest': lambda job, served: job.created,
+}
+
+
+class DownloadQueue(object):
+  """Pending downloads, handed out in order of a chain of policies.
+
+  Policies are compared in turn, so ['priority', 'round_robin'] serves the
+  highest priority watch folder first and alternates between shows within
+  it. Ties fall back to the order jobs were added in. Keys are recomputed on
+  every get(), so round robin reflects what has actually been started.
+  """
+  def __init__(self, policies=('priority',)):
+    unknown = [name for name in policies if name not in POLICIES]
+    if unknown: raise ValueError('Unknown scheduling policy: %s' % unknown[0])
+    self.policies = [POLICIES[name] for name in policies]
+    self.jobs = []
+    self.served = defaultdict(int)
+    self.counter = itertools.count()
+
+  def __len__(self):
+    return len(self.jobs)
+
+  def put(self, download, priority=0, show=None, size=0, created=None):
+    self.jobs.append(Job(download, priority, show, size, created,
+                         next(self.counter)))
+
+  def key(self, job):
+    return tuple(policy(job, self.served) for policy in self.policies) + (
+        job.order,)
+
+  def get(self):
+    """Remove and return the download that should start next."""
+    job = min(self.jobs, key=self.key)
+    self.jobs.remove(job)
+    self.served[job.show] += 1
+    return job.download
+
+
+class ConcurrencyController(object):
+  """AIMD limit on how many downloads run at once.
+
+  Every adjust() looks at the throughput and error rate since the last one.
+  If errors went above max_errors the limit halves. Otherwise, if all slots
+  were busy, it grows by one, or halves if throughput fell below drop times
+  the previous rate.
+  """
+  def __init__(self, minimum, maximum, max_errors=0.1, drop=0.8):
+    self.minimum = max(minimum, 1)
+    self.maximum = max(maximum, self.minimum)
+    self.limit = self.minimum
+    self.max_errors = max_errors
+    self.drop = drop
+    self.rate = 0.0
+    self.reset()
+
+  def reset(self):
+    self.bytes = self.successes = self.failures = 0
+    self.saturated = False
+    self.stamp = time.time()
+
+  def record(self, count):
+    self.bytes += count
+
+  def success(self):
+    self.successes += 1
+
+  def failure(self):
+    self.failures += 1
+
+  def wait(self, pool):
+    """Block until the pool has fewer running greenlets than the limit."""
+    while len(pool) >= self.limit:
+      self.saturated = True
+      gevent.sleep(0.5)
+
+  def adjust(self):
+    elapsed = time.time() - self.stamp
+    if not elapsed: return
+    rate = self.bytes/elapsed
+    attempts = self.successes + self.failures
+    errors = float(self.failures)/attempts if attempts else 0.0
+
+    limit = self.limit
+    if errors > self.max_errors:
+      limit = max(self.minimum, limit//2)
+    elif self.saturated and rate < self.rate*self.drop:
+      limit = max(self.minimum, limit//2)
+    elif self.saturated:
+      limit = min(self.maximum, limit + 1)
+    if limit != self.limit:
+      log.info('Download concurrency %d -> %d (%.0f bytes/s, %.0f%% errors).',
+               self.limit, limit, rate, errors*100)
+      self.limit = limit
+
+    self.rate = rate
+    self.reset()
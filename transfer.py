@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""Low-level helpers for writing downloads to disk."""
+
+__author__ = 'adam@adamia.com (Adam R. Smith)'
+
+import ctypes, ctypes.util
+import errno
+import os
+import shutil
+import sys
+import time
+import zlib
+
+import gevent
+
+
+POSIX_FADV_DONTNEED = 4
+# Kernel copies block the gevent hub, so they go this much at a time.
+COPY_CHUNK = 8*1024*1024
+
+_libc = None
+if sys.platform.startswith('linux'):
+  try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _libc.posix_fallocate.argtypes = (ctypes.c_int, ctypes.c_longlong,
+                                      ctypes.c_longlong)
+    _libc.posix_fadvise.argtypes = (ctypes.c_int, ctypes.c_longlong,
+                                    ctypes.c_longlong, ctypes.c_int)
+    _libc.sendfile.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.c_void_p,
+                               ctypes.c_size_t)
+    _libc.sendfile.restype = ctypes.c_ssize_t
+    if hasattr(_libc, 'copy_file_range'):  # Only in glibc 2.27 and up.
+      _libc.copy_file_range.argtypes = (ctypes.c_int, ctypes.c_void_p,
+                                        ctypes.c_int, ctypes.c_void_p,
+                                        ctypes.c_size_t, ctypes.c_uint)
+      _libc.copy_file_range.restype = ctypes.c_ssize_t
+  except (OSError, AttributeError):
+    _libc = None
+
+def preallocate(fd, size):
+  """Reserve size bytes for a file up front to avoid fragmentation."""
+  if _libc and not _libc.posix_fallocate(fd, 0, size):
+    return
+  # No fallocate (or the filesystem refused it), so just set the length.
+  if os.fstat(fd).st_size < size:
+    os.ftruncate(fd, size)
+
+def datasync(fd):
+  """Flush a file's data (but not necessarily its metadata) to disk."""
+  getattr(os, 'fdatasync', os.fsync)(fd)
+
+def drop_cache(fd, offset, length):
+  """Tell the kernel a synced range won't be read again soon."""
+  if _libc and length > 0:
+    _libc.posix_fadvise(fd, offset, length, POSIX_FADV_DONTNEED)
+
+def _gf2_times(mat, vec):
+  total, i = 0, 0
+  while vec:
+    if vec & 1: total ^= mat[i]
+    vec >>= 1
+    i += 1
+  return total
+
+def _gf2_square(mat):
+  return [_gf2_times(mat, row) for row in mat]
+
+def crc32_combine(crc1, crc2, len2):
+  """Return the crc32 of two joined blocks from their crcs, as in zlib."""
+  if len2 <= 0: return crc1
+  odd = [0xedb88320] + [1 << n for n in xrange(31)]
+  even = _gf2_square(odd)
+  odd = _gf2_square(even)
+  while True:
+    even = _gf2_square(odd)
+    if len2 & 1: crc1 = _gf2_times(even, crc1)
+    len2 >>= 1
+    if not len2: break
+    odd = _gf2_square(even)
+    if len2 & 1: crc1 = _gf2_times(odd, crc1)
+    len2 >>= 1
+    if not len2: break
+  return crc1 ^ crc2
+
+def _kernel_copies():
+  """Yield the available in-kernel copy calls, best first."""
+  if not _libc: return
+  if hasattr(_libc, 'copy_file_range'):
+    yield lambda src, dest, count: _libc.copy_file_range(src, None, dest, None,
+                                                         count, 0)
+  yield lambda src, dest, count: _libc.sendfile(dest, src, None, count)
+
+def copy_file(src_path, dest_path):
+  """Copy a file's data without passing it through userspace if possible.
+
+  The copy goes COPY_CHUNK bytes at a time, yielding to other greenlets in
+  between.
+  """
+  with open(src_path, 'rb') as src_file:
+    with open(dest_path, 'wb') as dest_file:
+      src_fd, dest_fd = src_file.fileno(), dest_file.fileno()
+      size, copied = os.fstat(src_fd).st_size, 0
+      for kernel_copy in _kernel_copies():
+        while copied < size:
+          count = kernel_copy(src_fd, dest_fd, min(size - copied, COPY_CHUNK))
+          if count <= 0: break
+          copied += count
+          gevent.sleep(0)
+        if copied >= size: break
+
+      if copied < size:  # No usable kernel copy, finish the slow way.
+        src_file.seek(copied)
+        dest_file.seek(copied)
+        while True:
+          data = src_file.read(1024*1024)
+          if not data: break
+          dest_file.write(data)
+          gevent.sleep(0)
+      dest_file.flush()
+      os.fsync(dest_fd)
+
+def move_file(src_path, dest_path):
+  """Move a file, copying it over when it crosses filesystems.
+
+  A plain rename is tried first. If that fails with EXDEV (which also
+  happens between bind mounts of one filesystem) the data is copied in the
+  kernel to a temporary name next to dest_path, synced, and then renamed
+  into place, so dest_path is never seen half written.
+  """
+  try:
+    os.rename(src_path, dest_path)
+    return
+  except OSError as e:
+    if e.errno != errno.EXDEV: raise
+
+  dest_dir = os.path.dirname(os.path.abspath(dest_path))
+  tmp_path = '%s.%d.tmp' % (dest_path, os.getpid())
+  try:
+    copy_file(src_path, tmp_path)
+    shutil.copystat(src_path, tmp_path)
+    os.rename(tmp_path, dest_path)
+  except (IOError, OSError):
+    if os.path.exists(tmp_path): os.remove(tmp_path)
+    raise
+  dir_fd = os.open(dest_dir, os.O_RDONLY)
+  try:
+    os.fsync(dir_fd)
+  finally:
+    os.close(dir_fd)
+  os.remove(src_path)
+
+def split_ranges(ranges, count):
+  """Split inclusive (first, last) ranges into about count similar pieces."""
+  total = sum(last - first + 1 for first, last in ranges)
+  step = max(-(-total // max(count, 1)), 1)
+  pieces = []
+  for first, last in ranges:
+    while first <= last:
+      end = min(first + step, last + 1) - 1
+      pieces.append((first, end))
+      first = end + 1
+  return pieces
+
+
+class Journal(object):
+  """Sidecar log of the byte ranges that have safely reached a download.
+
+  Each completed range is appended as a "first last" line, so a crash can at
+  worst tear the final line, which is ignored on load. While the journal
+  exists the download is incomplete, even if the file is already full size.
+  """
+  suffix = '.journal'
+
+  def __init__(self, path):
+    self.path = path + self.suffix
+    self.ranges = []
+    if self.exists():
+      self.load()
+
+  def exists(self):
+    return os.path.exists(self.path)
+
+  def load(self):
+    with open(self.path, 'r') as journal_file:
+      for line in journal_file:
+        try:
+          first, last = [int(n) for n in line.split()]
+        except ValueError:
+          continue
+        self._merge(first, last)
+
+  def _merge(self, first, last):
+    merged = []
+    for lo, hi in self.ranges:
+      if hi + 1 < first or last + 1 < lo:
+        merged.append((lo, hi))
+      else:
+        first, last = min(first, lo), max(last, hi)
+    merged.append((first, last))
+    merged.sort()
+    self.ranges = merged
+
+  def create(self):
+    open(self.path, 'a').close()
+
+  def add(self, first, last):
+    """Record that bytes first through last are on disk."""
+    if last < first: return
+    self._merge(first, last)
+    with open(self.path, 'a') as journal_file:
+      journal_file.write('%d %d\n' % (first, last))
+
+  def discard(self, first, last):
+    """Forget bytes first through last, rewriting the journal file."""
+    kept = []
+    for lo, hi in self.ranges:
+      if lo < first: kept.append((lo, min(hi, first - 1)))
+      if hi > last: kept.append((max(lo, last + 1), hi))
+    self.ranges = kept
+    tmp_path = self.path + '.tmp'
+    with open(tmp_path, 'w') as journal_file:
+      for lo, hi in kept:
+        journal_file.write('%d %d\n' % (lo, hi))
+    os.rename(tmp_path, self.path)
+
+  def completed(self):
+    return sum(last - first + 1 for first, last in self.ranges)
+
+  def missing(self, size):
+    """Return the inclusive ranges of a size byte file not yet on disk."""
+    gaps, pos = [], 0
+    for first, last in self.ranges:
+      if first > pos: gaps.append((pos, min(first, size) - 1))
+      pos = max(pos, last + 1)
+    if pos < size: gaps.append((pos, size - 1))
+    return [(first, last) for first, last in gaps if first <= last]
+
+  def remove(self):
+    if self.exists():
+      os.remove(self.path)
+    self.ranges = []
+
+
+class Copier(object):
+  """Copy loop from a response stream into a file with an adaptive read size.
+
+  The read size adapts between min_chunk and max_chunk: it doubles while
+  reads fill immediately and halves when a read stalls.
+  """
+  fast, slow = 0.01, 0.25
+
+  def __init__(self, min_chunk, max_chunk):
+    self.min_chunk = min(min_chunk, max_chunk)
+    self.max_chunk = max_chunk
+    self.chunk = self.min_chunk
+
+  def tune(self, filled, elapsed):
+    if filled and elapsed < self.fast:
+      self.chunk = min(self.chunk*2, self.max_chunk)
+    elif elapsed > self.slow:
+      self.chunk = max(self.chunk//2, self.min_chunk)
+
+  def copy(self, source, dest, limit=None, before=None, after=None):
+    """Copy limit bytes (or to EOF) from source to dest, returning the count.
+
+    before(amount) is called ahead of each read and after(data) once the
+    bytes have been written.
+    """
+    copied = 0
+    while limit is None or copied < limit:
+      amount = self.chunk if limit is None else min(self.chunk, limit - copied)
+      before and before(amount)
+      started = time.time()
+      data = source.read(amount)
+      count = len(data)
+      if not count: break
+      dest.write(data)
+      copied += count
+      self.tune(count == amount, time.time() - started)
+      after and after(data)
+    return copied
+
+
+class Checksum(object):
+  """Streaming CRC32 of a file whose ranges are written out of order.
+
+  Each contiguous piece keeps its own running crc, keyed by the offset it
+  starts at, and the pieces are combined in order once the file is complete.
+  """
+  read_size = 1024*1024
+
+  def __init__(self):
+    self.pieces = {}
+
+  def update(self, first, data):
+    """Extend the piece starting at offset first with data."""
+    crc, length = self.pieces.get(first, (0, 0))
+    self.pieces[first] = zlib.crc32(data, crc), length + len(data)
+
+  def read(self, src_file, first, last):
+    """Checksum bytes first through last already on disk.
+
+    Yields to other greenlets between reads, as this can take a while.
+    """
+    src_file.seek(first)
+    remaining = last - first + 1
+    while remaining > 0:
+      data = src_file.read(min(self.read_size, remaining))
+      if not data: break
+      self.update(first, data)
+      remaining -= len(data)
+      gevent.sleep(0)
+
+  def value(self, size):
+    """Return the crc32 of the whole file, or None if pieces are missing."""
+    crc, pos = 0, 0
+    for first in sorted(self.pieces):
+      piece_crc, length = self.pieces[first]
+      if first != pos: return None
+      crc = crc32_combine(crc, piece_crc & 0xffffffff, length)
+      pos += length
+    return crc if pos == size else None
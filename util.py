@@ -5,10 +5,16 @@
 
 __author__ = 'adam@adamia.com (Adam R. Smith)'
 
+from collections import OrderedDict
 from contextlib import contextmanager
+import logging as log
+import random
 import subprocess
 import sys
 import time
+import urlparse
+
+import gevent
 
 
 class AttrDict(dict):
@@ -40,55 +46,210 @@ def human_size(size):
   return '%.1f%s' % (size, _UNITS[i])
 
 
-class memoize(object):
-  """Memoize with timeout.
+class LRUCache(object):
+  """Size-bounded LRU cache whose entries also expire after timeout seconds.
 
-  This has been optimized repeatedly to squeeze out extra performance.
-  http://code.activestate.com/recipes/325905/ (r5)
-  Modified by Adam R. Smith
+  Expired entries are kept for another stale seconds, for callers willing to
+  use a stale value (see entry()). Counts hits, misses and evictions
+  (including expiries) for stats().
   """
-  _caches = {}
-  _timeouts = {}
+  missing = object()
+
+  def __init__(self, maxsize=128, timeout=0, stale=0):
+    self.maxsize = maxsize
+    self.timeout = timeout
+    self.stale = stale
+    self.data = OrderedDict()
+    self.hits = self.misses = self.evictions = 0
+
+  def __len__(self):
+    return len(self.data)
+
+  def entry(self, key, stale=False):
+    """Return (value, expired) for a cached key, or None.
+
+    Expired values are only returned if stale is set and they are no more
+    than the cache's stale seconds past their timeout.
+    """
+    if key in self.data:
+      value, ts = self.data.pop(key)
+      age = time.time() - ts
+      expired = bool(self.timeout) and age > self.timeout
+      if not self.timeout or age <= self.timeout + self.stale:
+        self.data[key] = value, ts
+        if stale or not expired:
+          self.hits += 1
+          return value, expired
+      else:
+        self.evictions += 1
+    self.misses += 1
+    return None
+
+  def get(self, key, default=missing):
+    """Return a fresh cached value, or default (LRUCache.missing) if none."""
+    entry = self.entry(key)
+    return default if entry is None else entry[0]
+
+  def set(self, key, value):
+    self.data.pop(key, None)
+    self.data[key] = value, time.time()
+    while self.maxsize and len(self.data) > self.maxsize:
+      self.data.popitem(last=False)
+      self.evictions += 1
 
-  def __init__(self, timeout=0):
+  def invalidate(self, key):
+    self.data.pop(key, None)
+
+  def clear(self):
+    self.data.clear()
+
+  def stats(self):
+    return {'size': len(self.data), 'hits': self.hits, 'misses': self.misses,
+            'evictions': self.evictions}
+
+
+class memoize(object):
+  """Memoize with timeout, in a bounded LRU cache.
+
+  The wrapped function gets a cache attribute holding its LRUCache, and an
+  invalidate(*args, **kwargs) method to drop the result for those arguments.
+
+  With stale set, it also gets a stale(*args, **kwargs) variant that returns
+  an expired result at once (if it is at most stale seconds past timeout) and
+  refreshes it in a background greenlet, rather than blocking on the call.
+  A refresh failing with one of errors is logged and the stale result kept;
+  anything else is left to crash the refresh greenlet.
+  """
+  def __init__(self, timeout=0, maxsize=128, stale=0, errors=()):
     self.timeout = timeout
+    self.maxsize = maxsize
+    self.stale = stale
+    self.errors = tuple(errors)
 
-  def collect(self):
-    """Clear cache of results which have timed out"""
-    for func in self._caches:
-      cache = {}
-      for key in self._caches[func]:
-        if (self._timeouts[func] <= 0 or
-            (time.time() - self._caches[func][key][1]) < self._timeouts[func]):
-          cache[key] = self._caches[func][key]
-      self._caches[func] = cache
+  @staticmethod
+  def key(args, kwargs):
+    key = tuple(args)
+    if kwargs:
+      key += tuple(sorted(kwargs.items()))
+    return key
 
   def __call__(self, f):
-    cache = self.cache = self._caches[f] = {}
-    timeout = self._timeouts[f] = self.timeout
+    cache = LRUCache(self.maxsize, self.timeout, self.stale)
+    refreshing = set()
 
     def func(*args, **kwargs):
-      key = tuple(args)
-      if len(kwargs):
-        kw = kwargs.items()
-        kw.sort()
-        key += tuple(kw)
-
-      cached = (key in cache)
-      if cached:
-        v = cache[key]
-        if timeout > 0 and (time.time() - v[1]) > timeout:
-          cached = False
-      if not cached:
-        ts = time.time() if timeout else 0
-        v = cache[key] = (f(*args, **kwargs), ts)
-      return v[0]
-    #func.func_name = f.func_name
+      key = self.key(args, kwargs)
+      value = cache.get(key)
+      if value is LRUCache.missing:
+        value = f(*args, **kwargs)
+        cache.set(key, value)
+      return value
+
+    def refresh(key, args, kwargs):
+      try:
+        cache.set(key, f(*args, **kwargs))
+      except self.errors as e:
+        # Keep serving the stale value; callers block once it's too old.
+        log.warning('Refreshing %s failed, serving a stale result: %s',
+                    f.func_name, e)
+      finally:
+        refreshing.discard(key)
+
+    def stale(*args, **kwargs):
+      key = self.key(args, kwargs)
+      entry = cache.entry(key, stale=True)
+      if entry is None:
+        value = f(*args, **kwargs)
+        cache.set(key, value)
+        return value
+      value, expired = entry
+      if expired and key not in refreshing:
+        refreshing.add(key)
+        gevent.spawn(refresh, key, args, kwargs)
+      return value
+    func.func_name = f.func_name
     func.__doc__ = f.__doc__
+    func.cache = cache
+    func.stale = stale
+    func.invalidate = lambda *args, **kwargs: cache.invalidate(
+        self.key(args, kwargs))
 
     return func
 
 
+class Backoff(object):
+  """Exponential backoff with jitter, bounded by attempts and elapsed time.
+
+  count is the total number of attempts, so delays() yields at most count - 1
+  waits. Each wait is between half and all of the current delay, which then
+  grows by factor up to max_delay.
+  """
+  def __init__(self, count=3, delay=1, factor=2, max_delay=300, max_elapsed=0):
+    self.count = count
+    self.delay = delay
+    self.factor = factor
+    self.max_delay = max_delay
+    self.max_elapsed = max_elapsed
+
+  def delays(self):
+    """Yield how long to wait before each retry, until retries run out."""
+    started, delay = time.time(), self.delay
+    for attempt in xrange(self.count - 1):
+      wait = delay/2.0 + random.uniform(0, delay/2.0)
+      if (self.max_elapsed and
+          time.time() - started + wait > self.max_elapsed):
+        return
+      yield wait
+      delay = min(delay*self.factor, self.max_delay)
+
+
+class CircuitBreaker(object):
+  """Stop calling a failing service until it has had time to recover.
+
+  After threshold consecutive failures the circuit opens and allow() refuses
+  calls for reset seconds. Then a single trial call is let through, which
+  either closes the circuit again or reopens it for another reset period.
+  """
+  def __init__(self, threshold=5, reset=60):
+    self.threshold = threshold
+    self.reset = reset
+    self.failures = 0
+    self.opened_at = None
+
+  @property
+  def is_open(self):
+    return self.opened_at is not None
+
+  def allow(self):
+    if not self.is_open: return True
+    if time.time() - self.opened_at < self.reset: return False
+    self.opened_at = time.time()  # Half-open, let just this one call through.
+    return True
+
+  def success(self):
+    self.failures = 0
+    self.opened_at = None
+
+  def failure(self):
+    self.failures += 1
+    if self.failures >= self.threshold:
+      self.opened_at = time.time()
+
+
+class Breakers(object):
+  """Per-host CircuitBreakers, looked up by url."""
+  def __init__(self, threshold=5, reset=60):
+    self.threshold = threshold
+    self.reset = reset
+    self.hosts = {}
+
+  def __call__(self, url):
+    host = urlparse.urlsplit(url).netloc
+    if host not in self.hosts:
+      self.hosts[host] = CircuitBreaker(self.threshold, self.reset)
+    return self.hosts[host]
+
+
 @contextmanager
 def caffeinate():
   """Disable system idle/sleep during a job. Mac-only for now."""